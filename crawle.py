@@ -1,14 +1,18 @@
 """CRAWL-E is a highly distributed web crawling framework."""
 
-import Queue, cStringIO, gzip, httplib, logging, mimetypes, resource, socket
-import sys, subprocess, threading, time, urllib, urlparse
+import Queue, collections, httplib, itertools, logging, mimetypes, resource
+import signal, socket, sys, threading, time, urllib, urlparse, zlib
 from optparse import OptionParser
 
 VERSION = '0.6.4'
-HEADER_DEFAULTS = {'Accept':'*/*', 'Accept-Language':'en-us,en;q=0.8',
+HEADER_DEFAULTS = {'Accept':'*/*', 'Accept-Encoding':'gzip',
+                   'Accept-Language':'en-us,en;q=0.8',
+                   'Connection':'keep-alive',
                    'User-Agent':'CRAWL-E/%s' % VERSION}
 DEFAULT_SOCKET_TIMEOUT = 30
-STOP_CRAWLE = False
+STOP_CRAWLE = threading.Event()
+_DNS_CACHE = {}
+_DNS_LOCKS = {}
 
 class CrawleException(Exception):
     """Base Crawle exception class."""
@@ -54,6 +58,12 @@ class RequestResponse(object):
     """This class is a container for information pertaining to requests and
     responses."""
 
+    __slots__ = ('error', 'redirects', 'extra', 'request_headers',
+                 'request_url', 'request_method', 'request_params',
+                 'request_files', 'response_status', 'response_url',
+                 'response_headers', 'response_body', 'response_time',
+                 '_parsed_url')
+
     def __init__(self, url, headers=None, method='GET', params=None,
                  files=None, redirects=10):
         """Constructs a RequestResponse object.
@@ -82,6 +92,62 @@ class RequestResponse(object):
         self.response_body = None
         self.response_time = None
 
+        # (url, urlparse result) of the last parsed response_url
+        self._parsed_url = None
+
+    def __getstate__(self):
+        """Return the attributes as a dictionary for pickling."""
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        """Restore the attributes from a pickled dictionary."""
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+def _resolve(hostname, ttl=300):
+    """Return the address for hostname, caching the result for ttl seconds.
+
+    Cache hits do not acquire a lock. Misses take a lock for that hostname
+    only, so a slow lookup does not block threads resolving other hosts.
+    """
+    entry = _DNS_CACHE.get(hostname)
+    if entry and entry[1] > time.time():
+        return entry[0]
+    # setdefault is atomic so every thread gets the same lock for hostname
+    with _DNS_LOCKS.setdefault(hostname, threading.Lock()):
+        entry = _DNS_CACHE.get(hostname)
+        if entry and entry[1] > time.time():
+            return entry[0]
+        address = socket.gethostbyname(hostname)
+        _DNS_CACHE[hostname] = address, time.time() + ttl
+    return address
+
+
+def _create_connection(address, *args):
+    """socket.create_connection to the cached address of the host."""
+    host, port = address
+    return socket.create_connection((_resolve(host), port), *args)
+
+
+class _HTTPConnection(httplib.HTTPConnection):
+    """HTTPConnection whose sockets connect to the cached host address. The
+    hostname is still used for the Host header."""
+
+    def __init__(self, *args, **kwargs):
+        httplib.HTTPConnection.__init__(self, *args, **kwargs)
+        self._create_connection = _create_connection
+
+
+class _HTTPSConnection(httplib.HTTPSConnection):
+    """HTTPSConnection whose sockets connect to the cached host address. The
+    hostname is still used for the Host header, SNI and certificate
+    checks."""
+
+    def __init__(self, *args, **kwargs):
+        httplib.HTTPSConnection.__init__(self, *args, **kwargs)
+        self._create_connection = _create_connection
+
 
 class HTTPConnectionQueue(object):
     """This class handles the queue of sockets for a particular address.
@@ -91,15 +157,16 @@ class HTTPConnectionQueue(object):
     request_count exceeds the REQUEST_LIMIT the connection is automatically
     reset.
     """
+    __slots__ = ('address', 'encrypted', 'queue', 'max_conn')
     REQUEST_LIMIT = None
 
     @staticmethod
     def connection_object(address, encrypted):
         """Very simply return a HTTP(S)Connection object."""
         if encrypted:
-            connection = httplib.HTTPSConnection(*address)
+            connection = _HTTPSConnection(*address)
         else:
-            connection = httplib.HTTPConnection(*address)
+            connection = _HTTPConnection(*address)
         connection.request_count = 0
         return connection
 
@@ -113,17 +180,13 @@ class HTTPConnectionQueue(object):
         """
         self.address = address
         self.encrypted = encrypted
-        self.queue = Queue.Queue(0)
-        self.connections = 0
+        self.queue = collections.deque()
         self.max_conn = max_conn
 
     def destroy(self):
         """Destroy the HTTPConnectionQueue object."""
-        try:
-            while True:
-                connection = self.queue.get(block=False)
-                connection.close()
-        except Queue.Empty: pass
+        while self.queue:
+            self.queue.popleft().close()
 
     def get(self):
         """Return a HTTP(S)Connection object for the appropriate address.
@@ -135,55 +198,27 @@ class HTTPConnectionQueue(object):
         keep track of the number of requests made with the specific connection.
         """
         try:
-            connection = self.queue.get(block=False)
-            self.connections -= 1
-            # Reset the connection if exceeds request limit
-            if (self.REQUEST_LIMIT and
-                connection.request_count >= self.REQUEST_LIMIT):
-                connection.close()
-                connection = HTTPConnectionQueue.connection_object(
-                    self.address, self.encrypted)
-        except Queue.Empty:
-            connection = HTTPConnectionQueue.connection_object(self.address,
-                                                               self.encrypted)
+            connection = self.queue.popleft()
+        except IndexError:
+            return HTTPConnectionQueue.connection_object(self.address,
+                                                         self.encrypted)
+        # Reset the connection if exceeds request limit
+        if (self.REQUEST_LIMIT and
+            connection.request_count >= self.REQUEST_LIMIT):
+            connection.close()
+            connection = HTTPConnectionQueue.connection_object(
+                self.address, self.encrypted)
         return connection
 
     def put(self, connection):
         """Put the HTTPConnection object back on the queue."""
         connection.request_count += 1
-        if self.max_conn != None and self.connections + 1 > self.max_conn:
+        if self.max_conn != None and len(self.queue) >= self.max_conn:
             connection.close()
         else:
-            self.queue.put(connection)
-            self.connections += 1
+            self.queue.append(connection)
 
 
-class QueueNode(object):
-    """This class handles an individual node in the CQueueLRU."""
-
-    def __init__(self, connection_queue, key, next=None):
-        """Construct a QueueNode object.
-
-        Keyword Arguments:
-        connection_queue -- The ConnectionQueue object.
-        key -- The unique identifier that allows one to perform a reverse
-               lookup in the hash table.
-        next -- The previous least recently used item.
-        """
-        
-        self.connection_queue = connection_queue
-        self.key = key
-        self.next = next
-        if next:
-            self.next.prev = self
-        self.prev = None
-
-    def remove(self):
-        """Properly remove the node"""
-        if self.prev:
-            self.prev.next = None
-        self.connection_queue.destroy()
-
 class CQueueLRU(object):
     """This class manages a least recently used list with dictionary lookup."""
 
@@ -200,61 +235,40 @@ class CQueueLRU(object):
         self.lock = threading.Lock()
         self.max_queues = max_queues
         self.max_conn = max_conn
-        self.table = {}
-        self.newest = None
-        self.oldest = None
+        self.table = collections.OrderedDict()
 
     def __getitem__(self, key):
         """Return either a HTTP(S)Connection object.
 
-        Fetches an already utilized object if one exists.
+        Fetches an already utilized object if one exists. The lookup does not
+        acquire the lock as single dictionary reads are atomic and the
+        HTTPConnectionQueue is itself threadsafe.
         """
-        self.lock.acquire()
-        if key in self.table:
-            connection = self.table[key].connection_queue.get()
-        else:
-            connection = HTTPConnectionQueue.connection_object(*key)
-        self.lock.release()
-        return connection
+        connection_queue = self.table.get(key)
+        if connection_queue:
+            return connection_queue.get()
+        return HTTPConnectionQueue.connection_object(*key)
 
     def __setitem__(self, key, connection):
         """Store the HTTP(S)Connection object.
 
         This function ensures that there are at most max_queues. In the event
-        there are too many, the oldest inactive queues will be deleted.
+        there are too many, the oldest inactive queues will be deleted. The
+        lock is only held while updating the table, the connection itself is
+        returned to its queue after the lock is released.
         """
-        self.lock.acquire()
-        if key in self.table:
-            node = self.table[key]
-            # move the node to the head of the list
-            if self.newest != node:
-                node.prev.next = node.next
-                if self.oldest != node:
-                    node.next.prev = node.prev
-                else:
-                    self.oldest = node.prev
-                node.prev = None
-                node.next = self.newest
-                self.newest = node.next.prev = node
-        else:
-            # delete the oldest while too many
-            while (self.max_queues != None and
-                   len(self.table) + 1 > self.max_queues):
-                if self.oldest == self.newest:
-                    self.newest = None
-                del self.table[self.oldest.key]
-                prev = self.oldest.prev
-                self.oldest.remove()
-                self.oldest = prev
-            connection_queue = HTTPConnectionQueue(*key,
-                                                    max_conn=self.max_conn)
-            node = QueueNode(connection_queue, key, self.newest)
-            self.newest = node
-            if not self.oldest:
-                self.oldest = node
-            self.table[key] = node
-        node.connection_queue.put(connection)
-        self.lock.release()
+        with self.lock:
+            # Reinserting moves the queue to the newest end of the table
+            connection_queue = self.table.pop(key, None)
+            if connection_queue is None:
+                # delete the oldest while too many
+                while (self.table and self.max_queues != None and
+                       len(self.table) + 1 > self.max_queues):
+                    self.table.popitem(last=False)[1].destroy()
+                connection_queue = HTTPConnectionQueue(*key,
+                                                        max_conn=self.max_conn)
+            self.table[key] = connection_queue
+        connection_queue.put(connection)
 
 
 class HTTPConnectionControl(object):
@@ -263,6 +277,7 @@ class HTTPConnectionControl(object):
     this class handles resetting the connection when it reaches a specified
     request limit.
     """
+    READ_SIZE = 65536
 
     def __init__(self, handler, max_queues=None, max_conn=None, timeout=None):
         """Constructs the HTTPConnection Control object. These objects are to
@@ -281,97 +296,130 @@ class HTTPConnectionControl(object):
 
     def _build_request(self, req_res):
         """Construct request headers and URI from request_response object."""
-        u = urlparse.urlparse(req_res.response_url)
+        parsed = req_res._parsed_url
+        if parsed and parsed[0] == req_res.response_url:
+            u = parsed[1]
+        else:
+            u = urlparse.urlparse(req_res.response_url)
+            req_res._parsed_url = req_res.response_url, u
         if u.scheme not in ['http', 'https'] or u.netloc == '':
             raise CrawleUnsupportedScheme()
 
-        address = socket.gethostbyname(u.hostname), u.port
+        address = u.hostname, u.port
         encrypted = u.scheme == 'https'
 
         url = urlparse.urlunparse(('', '', u.path, u.params, u.query, ''))
-        if req_res.request_headers:
-            headers = req_res.request_headers
+        headers = dict(HEADER_DEFAULTS)
+        if u.port == None:
+            headers['Host'] = u.hostname
         else:
-            headers = {}
-        if 'Accept' not in headers:
-            headers['Accept'] = HEADER_DEFAULTS['Accept']
-        if 'Accept-Encoding' not in headers:
-            headers['Accept-Encoding'] = 'gzip'
-        if 'Accept-Languge' not in headers:
-            headers['Accept-Language'] = HEADER_DEFAULTS['Accept-Language']
-        if 'Host' not in headers:
-            if u.port == None:
-                headers['Host'] = u.hostname
-            else:
-                headers['Host'] = '%s:%d' % (u.hostname, u.port)
-        if 'User-Agent' not in headers:
-            headers['User-Agent'] = HEADER_DEFAULTS['User-Agent']
+            headers['Host'] = '%s:%d' % (u.hostname, u.port)
+        if req_res.request_headers:
+            headers.update(req_res.request_headers)
         return address, encrypted, url, headers
 
     def request(self, req_res):
-        """Handles the request to the server."""
-        if STOP_CRAWLE:
-            raise CrawleStopped()
-
-        self.handler.pre_process(req_res)
-        if req_res.response_url == None:
-            raise CrawleRequestAborted()
+        """Handles the request to the server, following any redirects.
 
-        address, encrypted, url, headers = self._build_request(req_res)
-        connection = self.cq_lru[(address, encrypted)]
-            
+        Redirects are followed iteratively and a connection is kept across
+        hops to the same address rather than being returned to the pool.
+        """
+        key = connection = None
         try:
-            start = time.time()
-            if req_res.request_files:
-                content_type, data = self.encode_multipart_formdata(
-                    req_res.request_params, req_res.request_files)
-                headers['Content-Type'] = content_type
-            elif req_res.request_params:
-                data = urllib.urlencode(req_res.request_params)
-                headers['Content-Type'] = 'application/x-www-form-urlencoded'
-            else:
-                data = ''
-            connection.request(req_res.request_method, url, data, headers)
-            response = connection.getresponse()
-            response_time = time.time() - start
-            response_body = response.read()
-            self.cq_lru[(address, encrypted)] = connection
-        except Exception:
-            connection.close()
-            raise
-
-        if response.status in (301, 302, 303) and req_res.redirects != None:
-            if req_res.redirects <= 0:
-                raise CrawleRedirectsExceeded()
-            req_res.redirects -= 1
-            redirect_url = response.getheader('location')
-            req_res.response_url = urlparse.urljoin(req_res.response_url,
-                                                    redirect_url)
-            self.request(req_res)
-        else:
-            req_res.response_time = response_time
-            req_res.response_status = response.status
-            req_res.response_headers = dict(response.getheaders())
-            if ('content-encoding' in req_res.response_headers and
-                req_res.response_headers['content-encoding'] == 'gzip'):
+            while True:
+                if STOP_CRAWLE.is_set():
+                    raise CrawleStopped()
+
+                self.handler.pre_process(req_res)
+                if req_res.response_url == None:
+                    raise CrawleRequestAborted()
+
+                address, encrypted, url, headers = self._build_request(req_res)
+                if connection and key != (address, encrypted):
+                    self.cq_lru[key] = connection
+                    connection = None
+                if not connection:
+                    key = address, encrypted
+                    connection = self.cq_lru[key]
+
+                if req_res.request_files:
+                    content_type, data = self.encode_multipart_formdata(
+                        req_res.request_params, req_res.request_files)
+                    headers['Content-Type'] = content_type
+                elif req_res.request_params:
+                    data = urllib.urlencode(req_res.request_params)
+                    headers['Content-Type'] = \
+                        'application/x-www-form-urlencoded'
+                else:
+                    data = ''
+
                 try:
-                    fileobj = cStringIO.StringIO(response_body)
-                    temp = gzip.GzipFile(fileobj=fileobj)
-                    req_res.response_body = temp.read()
-                    temp.close()
-                    fileobj.close()
-                except IOError:
-                    # HACK for pages that append plain text to gzip output
-                    sb = subprocess.Popen(['zcat'], stdin=subprocess.PIPE,
-                                          stdout=subprocess.PIPE,
-                                          stderr=subprocess.PIPE)
-                    sb.stdin.write(response_body)
-                    sb.stdin.close()
-                    req_res.response_body = sb.stdout.read()
-                    del sb
-                    req_res.extra.append('Used zcat')
-            else:
-                req_res.response_body = response_body
+                    start = time.time()
+                    connection.request(req_res.request_method, url, data,
+                                       headers)
+                    response = connection.getresponse()
+                    response_time = time.time() - start
+                    redirect = (response.status in (301, 302, 303) and
+                                req_res.redirects != None)
+                    if (not redirect and response.getheader(
+                            'content-encoding', '').lower() == 'gzip'):
+                        response_body = self._read_gzip(response, req_res)
+                    else:
+                        response_body = response.read()
+                except Exception:
+                    connection.close()
+                    connection = None
+                    raise
+                if response.will_close:
+                    # Server closes the socket so there is nothing to reuse
+                    connection.close()
+                    connection = None
+
+                if not redirect:
+                    break
+                if req_res.redirects <= 0:
+                    raise CrawleRedirectsExceeded()
+                req_res.redirects -= 1
+                redirect_url = response.getheader('location', '')
+                u = req_res._parsed_url[1]
+                if redirect_url[:1] == '/' and redirect_url[1:2] != '/':
+                    # Same host absolute path, no need to parse the url again
+                    req_res.response_url = '%s://%s%s' % (u.scheme, u.netloc,
+                                                          redirect_url)
+                else:
+                    req_res.response_url = urlparse.urljoin(
+                        req_res.response_url, redirect_url)
+                req_res._parsed_url = None
+        finally:
+            if connection:
+                self.cq_lru[key] = connection
+
+        req_res.response_time = response_time
+        req_res.response_status = response.status
+        # HTTPMessage provides case insensitive dictionary access
+        req_res.response_headers = response.msg
+        req_res.response_body = response_body
+
+    def _read_gzip(self, response, req_res):
+        """Read and decompress a gzip encoded response body in chunks of
+        READ_SIZE so the compressed body is never held in memory whole."""
+        # 16 + MAX_WBITS tells zlib to expect the gzip header
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        body = []
+        chunk = response.read(self.READ_SIZE)
+        while chunk:
+            body.append(decompressor.decompress(chunk))
+            chunk = response.read(self.READ_SIZE)
+            if decompressor.unused_data[:2] == '\x1f\x8b':
+                # Another gzip member follows the one which just ended
+                chunk = decompressor.unused_data + chunk
+                body.append(decompressor.flush())
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        body.append(decompressor.flush())
+        if decompressor.unused_data:
+            # Some pages append plain text to the gzip output
+            req_res.extra.append('Ignored trailing data')
+        return ''.join(body)
 
     # The following function is modified from the snippet at:
     # http://code.activestate.com/recipes/146306/
@@ -427,10 +475,10 @@ class ControlThread(threading.Thread):
     def run(self):
         """This is the execution order of a single thread.
         
-        The threads will stop when STOP_CRAWLE becomes true, or when the queue
+        The threads will stop when STOP_CRAWLE is set, or when the queue
         raises Queue.Empty.
         """
-        while not STOP_CRAWLE:
+        while not STOP_CRAWLE.is_set():
             try:
                 request_response = self.queue.get()
             except Queue.Empty:
@@ -448,14 +496,20 @@ class Controller(object):
     """The primary controller manages all the threads."""
 	
     def __init__(self, handler, queue, num_threads=1,
-                 timeout=DEFAULT_SOCKET_TIMEOUT):
+                 timeout=DEFAULT_SOCKET_TIMEOUT, stack_size=None):
         """Create the controller object
 
         Keyword Arguments:
         handler -- The Handler class each thread will use for processing
-        queue -- The handle the the queue class
+        queue -- The handle the the queue class. If it implements wakeup, it
+                 is called when stopping to wake threads waiting in get.
         num_threads -- The number of threads to spawn (Default 1)
         timeout -- The socket timeout time
+        stack_size -- The stack size in bytes of each thread. The threads
+                      spend most of their time blocked on sockets, so a
+                      small stack (e.g. 256 KiB) allows many more threads
+                      than the platform default. (Default None, platform
+                      default)
         """
         nofiles = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
         queues = nofiles * 2 / (num_threads * 3)
@@ -464,6 +518,9 @@ class Controller(object):
                                                      max_conn=num_threads,
                                                      timeout=timeout)
         self.handler = handler
+        self.queue = queue
+        self.stack_size = stack_size
+        self._prev_sigint = None
 
         self.threads = []
         for _ in range(num_threads):
@@ -472,22 +529,56 @@ class Controller(object):
             self.threads.append(thread)
 
     def start(self):
-        """Starts all threads"""
-        for thread in self.threads:
-            thread.start()
+        """Starts all threads.
+
+        When called from the main thread, SIGINT is handled by setting
+        STOP_CRAWLE so the threads finish their current request and exit.
+        A second SIGINT is handled by the previous handler.
+        """
+        # Set first, an invalid size raises before anything else changes
+        if self.stack_size:
+            prev_size = threading.stack_size(self.stack_size)
+        try:
+            try:
+                self._prev_sigint = signal.signal(signal.SIGINT,
+                                                  self._interrupt)
+            except ValueError:
+                # Signal handlers can only be installed from the main thread
+                self._prev_sigint = None
+            for thread in self.threads:
+                thread.start()
+        finally:
+            if self.stack_size:
+                threading.stack_size(prev_size)
 
     def join(self):
         """Join on all threads"""
+        # A join without a timeout cannot be interrupted by signals
         for thread in self.threads:
-            while 1:
+            while thread.isAlive():
+                if STOP_CRAWLE.is_set() and hasattr(self.queue, 'wakeup'):
+                    self.queue.wakeup()
                 thread.join(1)
-                if not thread.isAlive():
-                    break
+        self._restore_sigint()
+
+    def _interrupt(self, signum, frame):
+        """SIGINT handler which stops the threads without waiting on them.
+
+        The handler runs in the main thread which may hold the queue's lock,
+        so waking the idle threads is left to join.
+        """
+        self._restore_sigint()
+        STOP_CRAWLE.set()
+
+    def _restore_sigint(self):
+        """Reinstall the SIGINT handler replaced in start."""
+        if self._prev_sigint is not None:
+            signal.signal(signal.SIGINT, self._prev_sigint)
+            self._prev_sigint = None
 
     def stop(self):
         """Stops all threads gracefully"""
-        global STOP_CRAWLE
-        STOP_CRAWLE = True
+        STOP_CRAWLE.set()
         self.join()
 
 
@@ -545,7 +636,7 @@ class CrawlQueue(object):
                 self._workers += 1
                 return item
             except Queue.Empty:
-                if self._workers == 0:
+                if self._workers == 0 or STOP_CRAWLE.is_set():
                     if self.cv:
                         self.cv.notify_all()
                     raise
@@ -570,6 +661,13 @@ class CrawlQueue(object):
             if self.cv:
                 self.cv.release()
 
+    def wakeup(self):
+        """Wake all threads waiting in get so they notice STOP_CRAWLE."""
+        if self.cv:
+            self.cv.acquire()
+            self.cv.notify_all()
+            self.cv.release()
+
     def work_complete(self):
         """Called by the ControlThread after the user defined handler has
         returned thus indicating no more items will be added to the queue from
@@ -596,13 +694,7 @@ class URLQueue(CrawlQueue):
     """URLQueue is the most basic queue type and is all that is needed for
     most situations. Simply, it queues full urls."""
 
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s') 
-    sh = logging.StreamHandler()
-    sh.setLevel(logging.DEBUG)
-    sh.setFormatter(formatter)
     logger = logging.getLogger('queue')
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(sh)
 
     LOG_STRING = 'Crawled: %d Remaining: %d RPS: %.2f (%.2f avg)'
 
@@ -613,10 +705,17 @@ class URLQueue(CrawlQueue):
         seedfile -- file containing urls to seed the queue (default None)
         """
         super(URLQueue, self).__init__(single_threaded)
-        self.queue = []
+        if not URLQueue.logger.handlers:
+            URLQueue.configure_logging()
+        elif URLQueue.logger.level == logging.NOTSET:
+            # Handlers added by the user still receive the info messages
+            URLQueue.logger.setLevel(logging.DEBUG)
+        self.queue = collections.deque()
         self.start_time = self.block_time = None
-        self.total_items = 0
         self.log_after = log_after
+        # next() on a count is atomic so getting items needs no extra lock
+        self._counter = itertools.count(1)
+        self._log_lock = threading.Lock()
 
         # Add seeded items to the queue
         if seed_file:
@@ -624,16 +723,35 @@ class URLQueue(CrawlQueue):
                 fp = open(seed_file)
             except IOError:
                 raise Exception('Could not open seed file')
-            for line in fp:
-                self.queue.append(line.strip())
+            self.queue.extend(line.rstrip('\r\n') for line in fp)
             fp.close()
             URLQueue.logger.info('Queued: %d from seed file' % len(self.queue))
         if seed_urls:
-            [self.queue.put(x) for x in seed_urls]
+            self.queue.extend(seed_urls)
             URLQueue.logger.info('Queued: %d from seed url' % len(seed_urls))
         if len(self.queue) == 0:
             URLQueue.logger.info('Starting with empty queue')
 
+    @classmethod
+    def configure_logging(cls, level=logging.DEBUG, stream=None):
+        """Attach a handler which writes the queue log to stream.
+
+        This is done automatically when a URLQueue is created and the queue
+        logger has no handlers. Call it beforehand, or add handlers to
+        URLQueue.logger, to log elsewhere.
+
+        Keyword arguments:
+        level -- The logging level (default logging.DEBUG)
+        stream -- The stream to write to (default sys.stderr)
+        """
+        formatter = logging.Formatter(
+            '%(asctime)s - %(levelname)s - %(message)s')
+        sh = logging.StreamHandler(stream)
+        sh.setLevel(level)
+        sh.setFormatter(formatter)
+        cls.logger.setLevel(level)
+        cls.logger.addHandler(sh)
+
     def save(self, save_file):
         """Outputs queue to file specified. On error prints queue to screen."""
         try:
@@ -649,25 +767,43 @@ class URLQueue(CrawlQueue):
             fp.close()
         URLQueue.logger.info('Saved %d items.' % items)
 
+    def get(self):
+        """Return the next RequestResponse and periodically log the crawl
+        rate. The logging happens outside of the queue's lock."""
+        request_response = super(URLQueue, self).get()
+        total_items = next(self._counter)
+        if total_items == 1:
+            self.start_time = self.block_time = time.time()
+        elif self.log_after and total_items % self.log_after == 0:
+            self._log_progress(total_items)
+        return request_response
+
+    def _log_progress(self, total_items):
+        """Log the crawl rate unless another thread is already doing so."""
+        if not self._log_lock.acquire(False):
+            return
+        try:
+            if self.start_time == None:
+                # The thread getting the first item has not set it yet
+                return
+            now = time.time()
+            if now == self.block_time:
+                # No measurable time has passed to compute a rate from
+                return
+            rps_now = self.log_after / (now - self.block_time)
+            rps_avg = total_items / (now - self.start_time)
+            log = URLQueue.LOG_STRING % (total_items, len(self.queue),
+                                         rps_now, rps_avg)
+            URLQueue.logger.info(log)
+            self.block_time = now
+        finally:
+            self._log_lock.release()
+
     def _get(self):
         """Return url at the head of the queue or raise Queue.Empty"""
-        if len(self.queue):
-            url = self.queue.pop(0)
-            self.total_items += 1
-            if self.start_time == None:
-                self.start_time = self.block_time = time.time()
-            elif (self.log_after and
-                  self.total_items % self.log_after == 0):
-                now = time.time()
-                rps_now = self.log_after / (now - self.block_time)
-                rps_avg = self.total_items / (now - self.start_time)
-                log = URLQueue.LOG_STRING % (self.total_items,
-                                             len(self.queue), rps_now,
-                                             rps_avg)
-                URLQueue.logger.info(log)
-                self.block_time = now
-            return RequestResponse(url)
-        else:
+        try:
+            return RequestResponse(self.queue.popleft())
+        except IndexError:
             raise Queue.Empty
 
     def _put(self, url):
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
-import Queue, crawle, socket, unittest
+import BaseHTTPServer, Queue, SocketServer, crawle, logging, pickle, signal
+import socket, tempfile, threading, time, unittest, zlib
 
 ADDRESS_0 = ('127.0.0.1', 80), False
 ADDRESS_1 = ('127.0.0.1', 443), True
@@ -10,17 +11,14 @@ class TestCQueueLRU(unittest.TestCase):
         self.lru = crawle.CQueueLRU(10, 10)
 
     def assert_newest(self, key):
-        self.assertEqual(self.lru.table[key], self.lru.newest)
-        self.assertEqual(None, self.lru.newest.prev)
+        self.assertEqual(key, self.lru.table.keys()[-1])
 
     def assert_oldest(self, key):
-        self.assertEqual(self.lru.table[key], self.lru.oldest)
-        self.assertEqual(None, self.lru.oldest.next)
+        self.assertEqual(key, self.lru.table.keys()[0])
 
     def testGetSingleItem(self):
         item = self.lru[ADDRESS_0]
-        self.assertEqual(None, self.lru.newest)
-        self.assertEqual(None, self.lru.oldest)
+        self.assertEqual(0, len(self.lru.table))
 
     def testPutSingleItem(self):
         item = self.lru[ADDRESS_0]
@@ -100,18 +98,30 @@ class TestCQueueLRU(unittest.TestCase):
         self.assertEqual(3, len(self.lru.table))
         self.assert_newest(ADDRESS_1)
         self.assert_oldest(ADDRESS_0)
-        self.assertEqual(self.lru.newest, self.lru.oldest.prev.prev)
-        self.assertEqual(self.lru.oldest, self.lru.newest.next.next)
+        self.assertEqual([ADDRESS_0, ADDRESS_2, ADDRESS_1],
+                         self.lru.table.keys())
+
+
+class TestRequestResponse(unittest.TestCase):
+    def testPickle(self):
+        rr = crawle.RequestResponse('http://127.0.0.1/', method='POST',
+                                    params={'CRAWL-E':'1'})
+        rr.response_status = 200
+        rr.extra.append('CRAWL-E')
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(rr, protocol))
+            for name in crawle.RequestResponse.__slots__:
+                self.assertEqual(getattr(rr, name), getattr(copy, name))
 
 
 class TestHTTPConnectionQueue(unittest.TestCase):
     def setUp(self):
-        self.cq = crawle.HTTPConnectionQueue(ADDRESS_0)
+        self.cq = crawle.HTTPConnectionQueue(*ADDRESS_0)
 
     def testQueueLength(self):
         temp = self.cq.get()
         for i in range(5):
-            self.assertEqual(i, self.cq.queue.qsize())
+            self.assertEqual(i, len(self.cq.queue))
             self.cq.put(temp)
 
     def testResetConnection(self):
@@ -143,9 +153,59 @@ class TestHTTPConnectionQueue(unittest.TestCase):
         item1 = self.cq.connection_object(*ADDRESS_0)
         self.cq.put(item0)
         self.cq.put(item1)
-        self.assertEqual(1, self.cq.queue.qsize())
+        self.assertEqual(1, len(self.cq.queue))
         self.assertEqual(item0, self.cq.get())
-        self.assertEqual(0, self.cq.queue.qsize())
+        self.assertEqual(0, len(self.cq.queue))
+
+    def testLimitConnectionsAfterNewConnection(self):
+        self.cq.max_conn = 1
+        item0 = self.cq.get()
+        item1 = self.cq.get()
+        self.cq.put(item0)
+        self.cq.put(item1)
+        self.assertEqual(1, len(self.cq.queue))
+
+
+class TestResolve(unittest.TestCase):
+    def setUp(self):
+        self.lookups = []
+        self.slow = threading.Event()
+        self.gethostbyname = socket.gethostbyname
+        socket.gethostbyname = self.fake_gethostbyname
+        crawle._DNS_CACHE.clear()
+
+    def tearDown(self):
+        self.slow.set()
+        socket.gethostbyname = self.gethostbyname
+        crawle._DNS_CACHE.clear()
+
+    def fake_gethostbyname(self, hostname):
+        self.lookups.append(hostname)
+        if hostname == 'slow.crawl-e.test':
+            self.slow.wait(5)
+        return '127.0.0.1'
+
+    def testCached(self):
+        self.assertEqual('127.0.0.1', crawle._resolve('crawl-e.test'))
+        self.assertEqual('127.0.0.1', crawle._resolve('crawl-e.test'))
+        self.assertEqual(['crawl-e.test'], self.lookups)
+
+    def testExpired(self):
+        crawle._resolve('crawl-e.test', ttl=-1)
+        crawle._resolve('crawl-e.test')
+        self.assertEqual(['crawl-e.test', 'crawl-e.test'], self.lookups)
+
+    def testSlowLookupDoesNotBlockOtherHosts(self):
+        thread = threading.Thread(target=crawle._resolve,
+                                  args=('slow.crawl-e.test',))
+        thread.start()
+        while not self.lookups:
+            time.sleep(0.01)
+        self.assertEqual('127.0.0.1', crawle._resolve('crawl-e.test'))
+        self.assertFalse(self.slow.is_set())
+        self.slow.set()
+        thread.join()
+        self.assertEqual(['slow.crawl-e.test', 'crawl-e.test'], self.lookups)
 
 
 class TestHTTPConnectionControl(unittest.TestCase):
@@ -160,11 +220,11 @@ class TestHTTPConnectionControl(unittest.TestCase):
 
     def testRequestSTOP_CRAWLE(self):
         try:
-            crawle.STOP_CRAWLE = True
+            crawle.STOP_CRAWLE.set()
             rr = crawle.RequestResponse('')
             self.assertRaises(crawle.CrawleStopped, self.cc.request, rr)
         finally:
-            crawle.STOP_CRAWLE = False
+            crawle.STOP_CRAWLE.clear()
 
     def testRequestPreProcess(self):
         rr = crawle.RequestResponse('http://google.com')
@@ -192,6 +252,40 @@ class TestHTTPConnectionControl(unittest.TestCase):
         self.assertEqual(False, encrypted)
         self.assertEqual('/', url)
 
+    def testBuildRequestHostname(self):
+        rr = crawle.RequestResponse('http://localhost/CRAWL-E')
+        address, encrypted, url, headers = self.cc._build_request(rr)
+        self.assertEqual(('localhost', None), address)
+
+    def testBuildRequestParsedURL(self):
+        rr = crawle.RequestResponse('http://127.0.0.1/CRAWL-E')
+        self.cc._build_request(rr)
+        parsed = rr._parsed_url
+        self.assertEqual('http://127.0.0.1/CRAWL-E', parsed[0])
+        self.cc._build_request(rr)
+        self.assertTrue(parsed is rr._parsed_url)
+        rr.response_url = 'http://127.0.0.1/other'
+        address, encrypted, url, headers = self.cc._build_request(rr)
+        self.assertEqual('/other', url)
+
+    def testBuildRequestDefaultHeaders(self):
+        rr = crawle.RequestResponse('http://127.0.0.1:1337/')
+        address, encrypted, url, headers = self.cc._build_request(rr)
+        self.assertEqual('127.0.0.1:1337', headers['Host'])
+        self.assertEqual(crawle.HEADER_DEFAULTS['Accept-Language'],
+                         headers['Accept-Language'])
+        self.assertEqual('keep-alive', headers['Connection'])
+        self.assertEqual(None, rr.request_headers)
+
+    def testBuildRequestOverrideHeaders(self):
+        rr = crawle.RequestResponse('http://127.0.0.1/',
+                                    headers={'Accept-Language':'de',
+                                             'Host':'example.com'})
+        address, encrypted, url, headers = self.cc._build_request(rr)
+        self.assertEqual('de', headers['Accept-Language'])
+        self.assertEqual('example.com', headers['Host'])
+        self.assertEqual('gzip', headers['Accept-Encoding'])
+
     def testRequestInvalidMethod(self):
         rr = crawle.RequestResponse('http://www.google.com', method='INVALID')
         self.cc.request(rr)
@@ -254,14 +348,14 @@ class TestHTTPConnectionControl(unittest.TestCase):
         self.assertTrue(rr.response_time > 0)
         self.assertTrue('gzip' in  rr.response_headers['content-encoding'])
 
-    def testRequestGzipViaZcat(self):
+    def testRequestGzipTrailingData(self):
         rr = crawle.RequestResponse('http://www.eweek.com/', redirects=1)
         self.cc.request(rr)
         self.assertEqual(200, rr.response_status)
         self.assertEqual(1, rr.redirects)
         self.assertTrue(rr.response_time > 0)
         self.assertTrue('gzip' in  rr.response_headers['content-encoding'])
-        self.assertTrue('Used zcat' in rr.extra)
+        self.assertTrue('Ignored trailing data' in rr.extra)
 
     def testRequestPost(self):
         rr = crawle.RequestResponse(
@@ -279,10 +373,196 @@ class TestHTTPConnectionControl(unittest.TestCase):
         self.assertRaises(socket.timeout, self.cc.request, rr)
 
 
+class LocalRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Helper class serving redirect chains for the local tests. A request
+    for /redirect/N redirects to /redirect/N-1 until N reaches 0. A request
+    for /gzip returns a gzipped body followed by plain text and /gzip/members
+    returns a body made up of two gzip members. A request for /close answers
+    with Connection: close."""
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def log_message(self, *args): pass
+
+    def gzip(self, data):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def do_GET(self):
+        if self.path == '/gzip':
+            body = self.gzip('CRAWL-E' * 100) + 'junk'
+        elif self.path == '/gzip/members':
+            body = self.gzip('A' * 10) + self.gzip('B' * 10)
+        else:
+            body = None
+        if body:
+            self.send_response(200)
+            self.send_header('Content-Encoding', 'GZIP')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path == '/close':
+            self.send_response(200)
+            self.send_header('Connection', 'close')
+            self.send_header('Content-Length', '7')
+            self.end_headers()
+            self.wfile.write('CRAWL-E')
+            self.close_connection = 1
+            return
+        hops = int(self.path.split('/')[-1])
+        if hops > 0:
+            self.send_response(302)
+            self.send_header('Location', '/redirect/%d' % (hops - 1))
+            body = ''
+        else:
+            self.send_response(200)
+            body = 'CRAWL-E'
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class LocalServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Helper class so kept alive connections do not block shutdown"""
+    daemon_threads = True
+
+
+class TestHTTPConnectionControlLocal(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalServer(('127.0.0.1', 0), LocalRequestHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.cc = crawle.HTTPConnectionControl(crawle.Handler(), timeout=1)
+
+    def tearDown(self):
+        for connection_queue in self.cc.cq_lru.table.values():
+            connection_queue.destroy()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testRequestLongRedirectChain(self):
+        rr = crawle.RequestResponse(self.url + '/redirect/1500',
+                                    redirects=2000)
+        self.cc.request(rr)
+        self.assertEqual(200, rr.response_status)
+        self.assertEqual(500, rr.redirects)
+        self.assertEqual('CRAWL-E', rr.response_body)
+        self.assertEqual(1, len(self.cc.cq_lru.table.values()[0].queue))
+
+    def testNewConnectionUsesDNSCache(self):
+        lookups = []
+        def fake_gethostbyname(hostname):
+            lookups.append(hostname)
+            return '127.0.0.1'
+        gethostbyname = socket.gethostbyname
+        socket.gethostbyname = fake_gethostbyname
+        crawle._DNS_CACHE.clear()
+        try:
+            address = 'crawl-e.test', self.server.server_address[1]
+            for _ in range(2):
+                connection = crawle.HTTPConnectionQueue.connection_object(
+                    address, False)
+                connection.request('GET', '/redirect/0')
+                response = connection.getresponse()
+                self.assertEqual('CRAWL-E', response.read())
+                connection.close()
+        finally:
+            socket.gethostbyname = gethostbyname
+            crawle._DNS_CACHE.clear()
+        self.assertEqual(['crawl-e.test'], lookups)
+
+    def testRequestGzip(self):
+        rr = crawle.RequestResponse(self.url + '/gzip')
+        self.cc.request(rr)
+        self.assertEqual(200, rr.response_status)
+        self.assertEqual('GZIP', rr.response_headers['Content-Encoding'])
+        self.assertEqual('CRAWL-E' * 100, rr.response_body)
+        self.assertTrue('Ignored trailing data' in rr.extra)
+
+    def testRequestGzipMembers(self):
+        for read_size in (self.cc.READ_SIZE, 1):
+            self.cc.READ_SIZE = read_size
+            rr = crawle.RequestResponse(self.url + '/gzip/members')
+            self.cc.request(rr)
+            self.assertEqual('A' * 10 + 'B' * 10, rr.response_body)
+            self.assertEqual([], rr.extra)
+
+    def testRequestGzipChunked(self):
+        self.cc.READ_SIZE = 16
+        rr = crawle.RequestResponse(self.url + '/gzip')
+        self.cc.request(rr)
+        self.assertEqual('CRAWL-E' * 100, rr.response_body)
+        self.assertTrue('Ignored trailing data' in rr.extra)
+        self.assertEqual(1, len(self.cc.cq_lru.table.values()[0].queue))
+
+    def testRequestConnectionClose(self):
+        self.cc.request(crawle.RequestResponse(self.url + '/redirect/0'))
+        self.assertEqual(1, len(self.cc.cq_lru.table.values()[0].queue))
+        rr = crawle.RequestResponse(self.url + '/close')
+        self.cc.request(rr)
+        self.assertEqual('CRAWL-E', rr.response_body)
+        self.assertEqual(0, len(self.cc.cq_lru.table.values()[0].queue))
+
+    def testRequestRedirectExceeded(self):
+        rr = crawle.RequestResponse(self.url + '/redirect/2', redirects=1)
+        self.assertRaises(crawle.CrawleRedirectsExceeded, self.cc.request, rr)
+        self.assertEqual(1, len(self.cc.cq_lru.table.values()[0].queue))
+
+
 class TestController(unittest.TestCase):
     def testInit(self):
         c = crawle.Controller(None, None, 1)
 
+    def testStackSize(self):
+        previous = threading.stack_size()
+        queue = crawle.URLQueue(log_after=0)
+        c = crawle.Controller(crawle.Handler(), queue, 2,
+                              stack_size=256 * 1024)
+        c.start()
+        c.join()
+        self.assertEqual(previous, threading.stack_size())
+
+    def testInvalidStackSize(self):
+        previous = signal.getsignal(signal.SIGINT)
+        c = crawle.Controller(crawle.Handler(), None, 1, stack_size=1)
+        self.assertRaises(ValueError, c.start)
+        self.assertEqual(previous, signal.getsignal(signal.SIGINT))
+        self.assertFalse(c.threads[0].isAlive())
+
+    def testStopQueueWithoutWakeup(self):
+        class GetPutQueue(object):
+            """Helper class implementing only the documented interface"""
+            def get(self):
+                time.sleep(0.2)
+                raise Queue.Empty
+            def put(self, item): pass
+            def work_complete(self): pass
+        c = crawle.Controller(crawle.Handler(), GetPutQueue(), 1)
+        try:
+            c.start()
+            c.stop()
+        finally:
+            crawle.STOP_CRAWLE.clear()
+        self.assertFalse(c.threads[0].isAlive())
+
+    def testInterrupt(self):
+        # Keep one item outstanding so the threads wait in the queue
+        queue = crawle.URLQueue(seed_urls=['http://127.0.0.1/'], log_after=0)
+        queue.get()
+        previous = signal.getsignal(signal.SIGINT)
+        c = crawle.Controller(crawle.Handler(), queue, 2)
+        try:
+            c.start()
+            c._interrupt(signal.SIGINT, None)
+            c.join()
+        finally:
+            crawle.STOP_CRAWLE.clear()
+        self.assertFalse([t for t in c.threads if t.isAlive()])
+        self.assertEqual(previous, signal.getsignal(signal.SIGINT))
+
 
 class TestCrawlQueue(unittest.TestCase):
     def queue_get(self):
@@ -324,12 +604,105 @@ class TestCrawlQueue(unittest.TestCase):
         self.q.work_complete()
         self.assertEqual(0, self.q._workers)
 
+    def testEmptyStopped(self):
+        self.q.get()
+        self.empty = True
+        try:
+            crawle.STOP_CRAWLE.set()
+            self.assertRaises(Queue.Empty, self.q.get)
+        finally:
+            crawle.STOP_CRAWLE.clear()
+
     def testSingleThreadException(self):
         self.q.get()
         self.empty = True
         self.assertEqual
         self.assertRaises(Exception, self.q.get)
 
+class TestURLQueueLogging(unittest.TestCase):
+    class RecordHandler(logging.Handler):
+        """Helper class which keeps the messages it handles"""
+        def __init__(self):
+            logging.Handler.__init__(self)
+            self.messages = []
+
+        def emit(self, record):
+            self.messages.append(record.getMessage())
+
+    def setUp(self):
+        self.logger = crawle.URLQueue.logger
+        self.handlers = self.logger.handlers[:]
+        self.level = self.logger.level
+        for handler in self.handlers:
+            self.logger.removeHandler(handler)
+        self.logger.setLevel(logging.NOTSET)
+
+    def tearDown(self):
+        for handler in self.logger.handlers[:]:
+            self.logger.removeHandler(handler)
+        for handler in self.handlers:
+            self.logger.addHandler(handler)
+        self.logger.setLevel(self.level)
+
+    def testDefaultHandler(self):
+        crawle.URLQueue(single_threaded=True)
+        self.assertEqual(1, len(self.logger.handlers))
+        self.assertEqual(logging.DEBUG, self.logger.level)
+        crawle.URLQueue(single_threaded=True)
+        self.assertEqual(1, len(self.logger.handlers))
+
+    def testUserHandler(self):
+        handler = self.RecordHandler()
+        self.logger.addHandler(handler)
+        crawle.URLQueue(seed_urls=['http://127.0.0.1/'], single_threaded=True)
+        self.assertEqual([handler], self.logger.handlers)
+        self.assertEqual(['Queued: 1 from seed url'], handler.messages)
+
+
+class TestURLQueue(unittest.TestCase):
+    def setUp(self):
+        self.q = crawle.URLQueue(single_threaded=True, log_after=0)
+
+    def testGetOrder(self):
+        self.q.put('http://127.0.0.1/0')
+        self.q.put('http://127.0.0.1/1')
+        self.assertEqual('http://127.0.0.1/0', self.q.get().request_url)
+        self.assertEqual('http://127.0.0.1/1', self.q.get().request_url)
+        self.assertEqual(0, len(self.q.queue))
+
+    def testEmpty(self):
+        self.assertRaises(Queue.Empty, self.q.get)
+
+    def testLogProgressBeforeStart(self):
+        self.q.log_after = 1
+        self.q._log_progress(2)
+        self.assertEqual(None, self.q.block_time)
+
+    def testLogProgressNoTimePassed(self):
+        self.q.log_after = 1
+        self.q.start_time = self.q.block_time = time.time()
+        now = time.time
+        time.time = lambda: self.q.block_time
+        try:
+            self.q._log_progress(2)
+        finally:
+            time.time = now
+
+    def testSeedURLs(self):
+        urls = ['http://127.0.0.1/0', 'http://127.0.0.1/1']
+        q = crawle.URLQueue(seed_urls=urls, single_threaded=True)
+        self.assertEqual(urls, list(q.queue))
+
+    def testSeedFile(self):
+        fp = tempfile.NamedTemporaryFile()
+        fp.write('http://127.0.0.1/0\r\nhttp://127.0.0.1/1\n')
+        fp.flush()
+        q = crawle.URLQueue(seed_file=fp.name, single_threaded=True)
+        fp.close()
+        self.assertEqual(['http://127.0.0.1/0', 'http://127.0.0.1/1'],
+                         list(q.queue))
+
+
 
 if __name__ == '__main__':
     unittest.main()